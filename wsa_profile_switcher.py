@@ -1,10 +1,13 @@
 import os
+import ctypes
 import subprocess
 import time
 import logging
 import sys
-import requests
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import wintypes
 from datetime import datetime
 
 # ==============================================
@@ -19,6 +22,87 @@ from datetime import datetime
 #
 # ==============================================
 
+TH32CS_SNAPPROCESS = 0x00000002
+INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+SYMBOLIC_LINK_FLAG_ALLOW_UNPRIVILEGED_CREATE = 0x2
+ERROR_FILE_NOT_FOUND = 2
+ERROR_INVALID_PARAMETER = 87
+DETACHED_PROCESS = 0x00000008
+CREATE_NEW_PROCESS_GROUP = 0x00000200
+
+class PROCESSENTRY32W(ctypes.Structure):
+    _fields_ = [
+        ("dwSize", wintypes.DWORD),
+        ("cntUsage", wintypes.DWORD),
+        ("th32ProcessID", wintypes.DWORD),
+        ("th32DefaultHeapID", ctypes.c_size_t),
+        ("th32ModuleID", wintypes.DWORD),
+        ("cntThreads", wintypes.DWORD),
+        ("th32ParentProcessID", wintypes.DWORD),
+        ("pcPriClassBase", wintypes.LONG),
+        ("dwFlags", wintypes.DWORD),
+        ("szExeFile", wintypes.WCHAR * wintypes.MAX_PATH),
+    ]
+
+if sys.platform == "win32":
+    _kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    _kernel32.CreateToolhelp32Snapshot.argtypes = [wintypes.DWORD, wintypes.DWORD]
+    _kernel32.CreateToolhelp32Snapshot.restype = wintypes.HANDLE
+    _kernel32.Process32FirstW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+    _kernel32.Process32FirstW.restype = wintypes.BOOL
+    _kernel32.Process32NextW.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESSENTRY32W)]
+    _kernel32.Process32NextW.restype = wintypes.BOOL
+    _kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    _kernel32.CloseHandle.restype = wintypes.BOOL
+    _kernel32.CreateSymbolicLinkW.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.DWORD]
+    _kernel32.CreateSymbolicLinkW.restype = wintypes.BOOLEAN
+    _kernel32.CopyFileW.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.BOOL]
+    _kernel32.CopyFileW.restype = wintypes.BOOL
+    _kernel32.DeleteFileW.argtypes = [wintypes.LPCWSTR]
+    _kernel32.DeleteFileW.restype = wintypes.BOOL
+    _IsUserAnAdmin = ctypes.WinDLL("shell32", use_last_error=True).IsUserAnAdmin
+    _IsUserAnAdmin.argtypes = []
+    _IsUserAnAdmin.restype = ctypes.c_int
+
+def _running_processes():
+    # Lower-cased image names of all running processes, from one Toolhelp snapshot
+    snapshot = _kernel32.CreateToolhelp32Snapshot(TH32CS_SNAPPROCESS, 0)
+    if snapshot == INVALID_HANDLE_VALUE:
+        raise ctypes.WinError(ctypes.get_last_error())
+    names = set()
+    entry = PROCESSENTRY32W()
+    entry.dwSize = ctypes.sizeof(PROCESSENTRY32W)
+    try:
+        found = _kernel32.Process32FirstW(snapshot, ctypes.byref(entry))
+        while found:
+            names.add(entry.szExeFile.lower())
+            found = _kernel32.Process32NextW(snapshot, ctypes.byref(entry))
+    finally:
+        _kernel32.CloseHandle(snapshot)
+    return names
+
+def _is_running(name):
+    return name.lower() in _running_processes()
+
+def _delete_file(path):
+    if not _kernel32.DeleteFileW(str(path)):
+        error = ctypes.get_last_error()
+        if error != ERROR_FILE_NOT_FOUND:
+            raise ctypes.WinError(error)
+
+def _symlink(source, target):
+    # Older Windows builds reject the unprivileged flag, retry without it like os.symlink does
+    if _kernel32.CreateSymbolicLinkW(str(target), str(source), SYMBOLIC_LINK_FLAG_ALLOW_UNPRIVILEGED_CREATE):
+        return
+    error = ctypes.get_last_error()
+    if error == ERROR_INVALID_PARAMETER and _kernel32.CreateSymbolicLinkW(str(target), str(source), 0):
+        return
+    raise ctypes.WinError(ctypes.get_last_error())
+
+def _copy_file(source, target):
+    if not _kernel32.CopyFileW(str(source), str(target), False):
+        raise ctypes.WinError(ctypes.get_last_error())
+
 class WSAProfileSwitcher:
     def __init__(self):
         self.local_appdata = os.getenv('LOCALAPPDATA')
@@ -29,55 +113,103 @@ class WSAProfileSwitcher:
         self.current_profile = self.profiles_dir / "_active.txt"
         self.logfile = self.profiles_dir / "_logs.log"
         
-        # Setup logging
-        logging.basicConfig(
-            filename=str(self.logfile),
-            level=logging.INFO,
-            format='%(asctime)s - %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        # String forms for subprocess arguments and kernel32 calls
+        self.wsa_client_str = str(self.wsa_client)
+        self.wsa_base_str = str(self.wsa_base)
+        self.profiles_dir_str = str(self.profiles_dir)
+        self.target_vhdx = os.path.join(self.wsa_base_str, "LocalCache", "userdata.2.vhdx")
+        self.target_dat = os.path.join(self.wsa_base_str, "Settings", "settings.dat")
+        self.file_handler = None
+
+    def setup_logging(self):
+        root = logging.getLogger()
+        root.setLevel(logging.INFO)
+        logfile = os.path.abspath(self.logfile)
+        for handler in root.handlers:
+            if isinstance(handler, logging.FileHandler) and handler.baseFilename == logfile:
+                # Already configured earlier in this process, don't duplicate every line
+                self.file_handler = handler
+                return
+
+        # Log file is only opened on the first record
+        self.file_handler = logging.FileHandler(self.logfile, delay=True)
+        self.file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+        root.addHandler(self.file_handler)
+
+        # Also log to console, unless an earlier switcher already added its console handler
+        if any(h.name == "wsa_profile_switcher.console" for h in root.handlers):
+            return
         
-        # Also log to console
-        console_handler = logging.StreamHandler()
+        # Take over a bare stderr handler left by logging.basicConfig() rather than printing every line twice
+        console_handler = next((h for h in root.handlers if type(h) is logging.StreamHandler), None)
+        if console_handler is None:
+            console_handler = logging.StreamHandler()
+            root.addHandler(console_handler)
+        console_handler.name = "wsa_profile_switcher.console"
         console_handler.setLevel(logging.INFO)
         formatter = logging.Formatter('%(asctime)s - %(message)s', datefmt='%H:%M:%S')
         console_handler.setFormatter(formatter)
-        logging.getLogger().addHandler(console_handler)
+
+    def close_logging(self):
+        # Separate runs with a blank line, written through the already open log stream
+        if self.file_handler is not None and self.file_handler.stream is not None:
+            self.file_handler.stream.write('\n')
+        logging.shutdown()
 
     def check_admin(self):
-        try:
-            return os.getuid() == 0
-        except AttributeError:
-            import ctypes
-            return ctypes.windll.shell32.IsUserAnAdmin() != 0
+        if sys.platform == "win32":
+            return bool(_IsUserAnAdmin())
+        return os.getuid() == 0
 
     def get_valid_profiles(self):
-        profiles = []
-        for vhdx_file in self.profiles_dir.glob("*.vhdx"):
-            dat_file = vhdx_file.with_suffix('.dat')
-            if dat_file.exists():
-                profiles.append(vhdx_file.stem)
-            else:
-                logging.warning(f"Found orphaned VHDX file: {vhdx_file.name}")
-        return profiles
+        # Extensions match case-insensitively like the filesystem, keyed by lower-case stem
+        vhdx, dat = {}, set()
+        with os.scandir(self.profiles_dir_str) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                name = entry.name
+                lower = name.lower()
+                if lower.endswith('.vhdx'):
+                    vhdx[lower[:-5]] = name
+                elif lower.endswith('.dat'):
+                    dat.add(lower[:-4])
+        for key in sorted(vhdx.keys() - dat):
+            logging.warning(f"Found orphaned VHDX file: {vhdx[key]}")
+        return [vhdx[key][:-5] for key in sorted(vhdx.keys() & dat)]
 
     def read_queue(self):
         if self.queue_file.exists():
             with open(self.queue_file, 'r', encoding='utf-8') as f:
-                return [line.strip() for line in f if line.strip()]
-        return []
+                return deque(line.strip() for line in f if line.strip())
+        return deque()
+
+    def write_atomic(self, path, text):
+        # Write beside the target and rename over it, so a killed run never leaves it truncated
+        tmp = path.with_suffix('.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(text.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except Exception:
+            # Don't leave the temp file behind in the profiles directory
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+            raise
 
     def write_queue(self, queue):
-        with open(self.queue_file, 'w', encoding='utf-8') as f:
-            for profile in queue:
-                f.write(f"{profile}\n")
+        self.write_atomic(self.queue_file, "".join(f"{profile}\n" for profile in queue))
 
     def update_queue(self):
         valid_profiles = self.get_valid_profiles()
         current_queue = self.read_queue()
         
         # Remove invalid profiles
-        current_queue = [p for p in current_queue if p in valid_profiles]
+        current_queue = deque(p for p in current_queue if p in valid_profiles)
         
         # Add new profiles
         for profile in valid_profiles:
@@ -85,74 +217,83 @@ class WSAProfileSwitcher:
                 current_queue.append(profile)
         
         if not current_queue:
-            current_queue = ["profile1"]
+            current_queue = deque(["profile1"])
             logging.warning("No valid profiles found. Created default profile.")
         
-        self.write_queue(current_queue)
+        return current_queue
 
-    def stop_wsa(self):
-        try:
-            subprocess.run([str(self.wsa_client), "/shutdown"], check=True, capture_output=True)
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"First shutdown attempt failed: {e.stderr.decode()}")
-        
-        try:
-            subprocess.run(["taskkill", "/F", "/IM", "WsaSettings.exe"], capture_output=True)
-        except subprocess.CalledProcessError as e:
-            logging.warning(f"Failed to terminate WsaSettings: {e.stderr.decode()}")
-        
-        time.sleep(2)
-        
+    def still_running(self, processes):
+        running = _running_processes()
+        return {p for p in processes if p.lower() in running}
+
+    def wait_for_exit(self, processes, attempts=5, interval=0.3):
+        running = self.still_running(processes)
+        for _ in range(attempts):
+            if not running:
+                break
+            time.sleep(interval)
+            running = self.still_running(processes)
+        return running
+
+    def request_shutdown(self, attempt):
         try:
-            subprocess.run([str(self.wsa_client), "/shutdown"], check=True, capture_output=True)
+            subprocess.run([self.wsa_client_str, "/shutdown"], check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                           encoding='utf-8', errors='replace')
         except subprocess.CalledProcessError as e:
-            logging.warning(f"Second shutdown attempt failed: {e.stderr.decode()}")
+            logging.warning(f"{attempt} shutdown attempt failed: {e.stderr}")
+
+    def stop_wsa(self):
+        self.request_shutdown("First")
         
-        time.sleep(2)
+        # The client exits long before the VM, only vmmemWSA going away means the profile files are released
+        client_processes = {"WsaClient.exe", "WsaSettings.exe"}
+        vm_processes = {"vmmemWSA"}
+        wsa_processes = client_processes | vm_processes
+        running = self.wait_for_exit(wsa_processes, attempts=6, interval=0.5)
+        if not running:
+            return
         
-        # Check for WSA processes
-        wsa_processes = ["WsaClient.exe", "WsaSettings.exe"]
-        for process in wsa_processes:
-            result = subprocess.run(["tasklist", "/FI", f"IMAGENAME eq {process}"], 
-                                  capture_output=True, text=True)
-            if process in result.stdout:
-                logging.warning(f"Process {process} is still running")
-                try:
-                    subprocess.run(["taskkill", "/F", "/IM", process], capture_output=True)
-                except subprocess.CalledProcessError as e:
-                    logging.warning(f"Failed to force terminate {process}: {e.stderr.decode()}")
+        logging.warning(f"Processes still running: {', '.join(sorted(running))}")
+        if running & client_processes:
+            # Terminate the leftover client process trees in one call, the script already runs elevated
+            subprocess.run(["taskkill", "/F", "/T", "/IM", "WsaClient.exe", "/IM", "WsaSettings.exe"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if running & vm_processes:
+            self.request_shutdown("Second")
         
         # Final check after force termination
-        time.sleep(1)
-        result = subprocess.run(["tasklist", "/FI", "IMAGENAME eq WsaClient.exe"], 
-                              capture_output=True, text=True)
-        if "WsaClient.exe" in result.stdout:
+        if self.wait_for_exit(wsa_processes, attempts=10, interval=0.5):
             logging.error("WSA processes still running after shutdown attempts")
             raise RuntimeError("Failed to stop WSA completely")
 
     def start_wsa(self):
         try:
-            subprocess.Popen([str(self.wsa_client)])
-            time.sleep(10)
+            process = subprocess.Popen([self.wsa_client_str])
             
-            if not subprocess.run(["tasklist", "/FI", "IMAGENAME eq WsaClient.exe"], capture_output=True).returncode == 0:
-                raise RuntimeError("Failed to start WSA")
+            # WsaClient has no readiness signal, only an exit code if it ends while booting
+            try:
+                returncode = process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                return
+            if returncode != 0:
+                raise RuntimeError(f"Failed to start WSA (exit code {returncode})")
         except Exception as e:
             logging.error(f"Error starting WSA: {e}")
             raise
 
     def switch_profile(self):
-        try:
-            if not self.check_admin():
-                logging.error("This script requires administrator privileges")
-                raise RuntimeError("Administrator privileges required")
+        if not self.check_admin():
+            raise RuntimeError("This script requires administrator privileges")
 
+        self.setup_logging()
+        try:
             # Create profiles directory if it doesn't exist
-            self.profiles_dir.mkdir(parents=True, exist_ok=True)
+            if not os.path.isdir(self.profiles_dir_str):
+                self.profiles_dir.mkdir(parents=True)
 
             # Update queue and get next profile
-            self.update_queue()
-            current_queue = self.read_queue()
+            current_queue = self.update_queue()
             if not current_queue:
                 raise RuntimeError("No profiles in queue")
             
@@ -160,45 +301,56 @@ class WSAProfileSwitcher:
             logging.info(f"Switching to profile: {next_profile}")
             
             # Setup profile files
-            source_vhdx = self.profiles_dir / f"{next_profile}.vhdx"
-            source_dat = self.profiles_dir / f"{next_profile}.dat"
-            target_vhdx = self.wsa_base / "LocalCache/userdata.2.vhdx"
-            target_dat = self.wsa_base / "Settings/settings.dat"
+            source_vhdx = os.path.join(self.profiles_dir_str, f"{next_profile}.vhdx")
+            source_dat = os.path.join(self.profiles_dir_str, f"{next_profile}.dat")
+            target_vhdx = self.target_vhdx
+            target_dat = self.target_dat
             
-            if not source_vhdx.exists() or not source_dat.exists():
+            if not os.path.exists(source_vhdx) or not os.path.exists(source_dat):
                 raise RuntimeError(f"Profile files not found for {next_profile}")
             
-            # Stop WSA and update files
-            self.stop_wsa()
-            
-            # Remove existing files
-            if target_vhdx.exists():
-                target_vhdx.unlink()
-            if target_dat.exists():
-                target_dat.unlink()
-            
-            # Create symbolic link and copy file
-            os.symlink(source_vhdx, target_vhdx)
-            import shutil
-            shutil.copy2(source_dat, target_dat)
+            # Stop WSA while staging the settings copy next to its target
+            staged_dat = target_dat + ".new"
+            try:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    stopping = executor.submit(self.stop_wsa)
+                    staging = executor.submit(_copy_file, source_dat, staged_dat)
+                if stopping.exception() is not None and staging.exception() is not None:
+                    logging.warning(f"Failed to stage settings copy: {staging.exception()}")
+                stopping.result()
+                staging.result()
+
+                # Replace the existing link
+                _delete_file(target_vhdx)
+
+                # Create symbolic link and move staged settings into place
+                _symlink(source_vhdx, target_vhdx)
+                os.replace(staged_dat, target_dat)
+            except Exception:
+                # Don't leave the staged copy behind in WSA's Settings directory
+                try:
+                    _delete_file(staged_dat)
+                except OSError as e:
+                    logging.warning(f"Failed to remove staged settings copy: {e}")
+                raise
             
             # Update queue
-            current_queue.remove(next_profile)
-            current_queue.append(next_profile)
+            current_queue.rotate(-1)
             self.write_queue(current_queue)
             
             # Save current profile
-            with open(self.current_profile, 'w', encoding='utf-8') as f:
-                f.write(next_profile)
+            self.write_atomic(self.current_profile, next_profile)
             
             # Start WSA and launch Google Photos
             self.start_wsa()
             self.launch_google_photos()
             
-            # Send heartbeat to uptime monitoring
+            # Send heartbeat to uptime monitoring without waiting for the response
             try:
-                requests.get("https://SUCCESS_URL.com")
-                logging.info("Successfully sent heartbeat to uptime monitoring")
+                subprocess.Popen(["curl.exe", "-s", "-m", "3", "-o", "NUL", "https://SUCCESS_URL.com"],
+                                 stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                 creationflags=DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP)
+                logging.info("Dispatched heartbeat to uptime monitoring")
             except Exception as e:
                 logging.warning(f"Failed to send heartbeat: {e}")
             
@@ -209,39 +361,38 @@ class WSAProfileSwitcher:
             raise
 
     def launch_google_photos(self):
+        # Photos runs inside the WSA VM, so the /launch exit code is the only signal it started
         max_retries = 3
         for attempt in range(max_retries):
             try:
-                subprocess.run([str(self.wsa_client), "/launch", "wsa://com.google.android.apps.photos"], 
-                             capture_output=True)
-                time.sleep(20)
-                
-                if subprocess.run(["tasklist", "/FI", "IMAGENAME eq WsaClient.exe"], 
-                                capture_output=True).returncode == 0:
+                result = subprocess.run([self.wsa_client_str, "/launch", "wsa://com.google.android.apps.photos"], 
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                if result.returncode == 0:
                     return
-                
-                if attempt < max_retries - 1:
-                    time.sleep(5)
-            except Exception as e:
+                logging.warning(f"Google Photos launch exited with code {result.returncode}")
+            except OSError as e:
                 logging.warning(f"Error launching Google Photos: {e}")
-                if attempt < max_retries - 1:
-                    continue
-                raise
+            
+            if attempt < max_retries - 1:
+                time.sleep(5)
         
         logging.warning(f"Failed to launch Google Photos after {max_retries} attempts")
         raise RuntimeError("Failed to launch Google Photos")
 
 def main():
+    switcher = None
     try:
         switcher = WSAProfileSwitcher()
         switcher.switch_profile()
-        with open(switcher.logfile, 'a', encoding='utf-8') as f:
-            f.write('\n')
+        switcher.close_logging()
         sys.exit(0)
     except Exception as e:
+        # Failures before logging was set up (e.g. no admin rights) only go to stderr
+        if switcher is None or switcher.file_handler is None:
+            print(f"Script failed: {e}", file=sys.stderr)
+            sys.exit(1)
         logging.error(f"Script failed: {e}")
-        with open(switcher.logfile, 'a', encoding='utf-8') as f:
-            f.write('\n')
+        switcher.close_logging()
         sys.exit(1)
 
 if __name__ == "__main__":